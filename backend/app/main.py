@@ -1,11 +1,12 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Tuple
+import functools
 import os
 import re
 from datetime import datetime, timedelta, date
-from sklearn.feature_extraction.text import TfidfVectorizer
 import numpy as np
 
 from .receipt_ocr import extract_receipt
@@ -20,7 +21,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Query parsing patterns, compiled once
+_ISO_DATE = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")
+_DAY_MONTH = re.compile(r"\b(\d{1,2})\s+(january|february|march|april|may|june|july|august|"
+                        r"september|october|november|december)(\s+\d{4})?\b")
+_ISO_RANGE = re.compile(r"from\s+(\d{4}-\d{2}-\d{2})\s+to\s+(\d{4}-\d{2}-\d{2})")
+_DAY_MONTH_RANGE = re.compile(r"between\s+(\d{1,2}\s+\w+(?:\s+\d{4})?)\s+and\s+(\d{1,2}\s+\w+(?:\s+\d{4})?)")
+_YEAR = re.compile(r"\d{4}")
+_WHERE_BUY = re.compile(r"where did i buy (.+?)(?: from| on|$)")
+
 VSTORE_PATH = os.environ.get("VSTORE_PATH", "/data/vectors.jsonl")
+# Minimum MiniLM cosine for "where did I buy X" to name a merchant. The default is a cautious
+# placeholder, not a calibrated value: it errs towards "No purchases of X" rather than naming an
+# unrelated item. Override it with a value measured on the int8 scores of the real store.
+MERCHANT_MIN_SIMILARITY = float(os.environ.get("MERCHANT_MIN_SIMILARITY", "0.5"))
 vdb = VectorStore(VSTORE_PATH)
 
 
@@ -55,6 +69,7 @@ async def upload_receipt(file: UploadFile = File(...)):
     merchant = meta.get("merchant") or "Unknown"
 
     stored_items = []
+    records = []
 
     for it in items:
         name = (it.get("name") or "").strip()
@@ -69,7 +84,7 @@ async def upload_receipt(file: UploadFile = File(...)):
         unit_price = float(it.get("unit_price") or 0) if it.get("unit_price") is not None else None
         line_total = float(it.get("line_total") or price)
 
-        vdb.upsert(item_id, {
+        records.append((item_id, {
             "text": name,
             "merchant": merchant,
             "date": str(purchase_date),
@@ -77,7 +92,7 @@ async def upload_receipt(file: UploadFile = File(...)):
             "quantity": qty,
             "unit_price": unit_price,
             "line_total": line_total
-        })
+        }))
 
         stored_items.append({
             "id": item_id,
@@ -88,6 +103,11 @@ async def upload_receipt(file: UploadFile = File(...)):
             "line_total": line_total
         })
 
+    # One encoder pass for the whole receipt. Encoding, fsync and compaction block (and the store
+    # lock may be held by another request), so keep them off the event loop.
+    await run_in_threadpool(vdb.upsert_many, records)
+    await run_in_threadpool(vdb.flush)
+
     return {
         "receipt_date": str(purchase_date),
         "merchant": merchant,
@@ -97,43 +117,43 @@ async def upload_receipt(file: UploadFile = File(...)):
     }
 
 
-def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
-    a = np.atleast_2d(a)
-    b = np.atleast_2d(b)
-
-    a_norm = a / np.linalg.norm(a, axis=1, keepdims=True)
-    b_norm = b / np.linalg.norm(b, axis=1, keepdims=True)
-
-    sim_matrix = np.dot(a_norm, b_norm.T)
-    return sim_matrix.flatten()
-
-
+@functools.lru_cache(maxsize=4096)
 def parse_date(s: str):
     """Parse YYYY-MM-DD safely into Python date."""
     if not s or not isinstance(s, str):
         return None
+    # C-level parser for canonical YYYY-MM-DD, several times faster than strptime. The shape
+    # check keeps Python 3.11+'s wider ISO forms ("20250104", "2025-W01-1") rejected as before.
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        try:
+            return date.fromisoformat(s)
+        except ValueError:
+            pass
     try:
+        # strptime also accepts unpadded fields such as 2025-1-4
         return datetime.strptime(s, "%Y-%m-%d").date()
     except Exception:
         return None
 
 
 def extract_explicit_date(query: str):
-    q = query.lower()
+    # Year-less dates resolve against the current year, so it is part of the cache key
+    return _extract_explicit_date(query.lower(), datetime.utcnow().year)
+
 
-    m = re.search(r"\b(\d{4})-(\d{2})-(\d{2})\b", q)
+@functools.lru_cache(maxsize=4096)
+def _extract_explicit_date(q: str, current_year: int):
+    m = _ISO_DATE.search(q)
     if m:
-        try:
-            return datetime.strptime(m.group(0), "%Y-%m-%d").date()
-        except Exception:
-            pass
+        d = parse_date(m.group(0))
+        if d:
+            return d
 
-    m = re.search(r"\b(\d{1,2})\s+(january|february|march|april|may|june|july|august|"
-                  r"september|october|november|december)(\s+\d{4})?\b", q)
+    m = _DAY_MONTH.search(q)
     if m:
         day = int(m.group(1))
         month = m.group(2).title()
-        year = int(m.group(3).strip()) if m.group(3) else datetime.utcnow().year
+        year = int(m.group(3).strip()) if m.group(3) else current_year
         try:
             return datetime.strptime(f"{day} {month} {year}", "%d %B %Y").date()
         except Exception:
@@ -143,26 +163,26 @@ def extract_explicit_date(query: str):
 
 
 def extract_date_range(query: str) -> Tuple[date, date] | None:
-    q = query.lower()
+    return _extract_date_range(query.lower(), datetime.utcnow().year)
 
-    m = re.search(r"from\s+(\d{4}-\d{2}-\d{2})\s+to\s+(\d{4}-\d{2}-\d{2})", q)
+
+@functools.lru_cache(maxsize=4096)
+def _extract_date_range(q: str, current_year: int) -> Tuple[date, date] | None:
+    m = _ISO_RANGE.search(q)
     if m:
-        try:
-            d1 = datetime.strptime(m.group(1), "%Y-%m-%d").date()
-            d2 = datetime.strptime(m.group(2), "%Y-%m-%d").date()
+        d1, d2 = parse_date(m.group(1)), parse_date(m.group(2))
+        if d1 and d2:
             return d1, d2
-        except Exception:
-            pass
 
-    m = re.search(r"between\s+(\d{1,2}\s+\w+(?:\s+\d{4})?)\s+and\s+(\d{1,2}\s+\w+(?:\s+\d{4})?)", q)
+    m = _DAY_MONTH_RANGE.search(q)
     if m:
         try:
-            d1 = datetime.strptime(m.group(1), "%d %B %Y" if re.search(r"\d{4}", m.group(1)) else "%d %B").date()
-            d2 = datetime.strptime(m.group(2), "%d %B %Y" if re.search(r"\d{4}", m.group(2)) else "%d %B").date()
+            d1 = datetime.strptime(m.group(1), "%d %B %Y" if _YEAR.search(m.group(1)) else "%d %B").date()
+            d2 = datetime.strptime(m.group(2), "%d %B %Y" if _YEAR.search(m.group(2)) else "%d %B").date()
             if d1.year == 1900:
-                d1 = d1.replace(year=datetime.utcnow().year)
+                d1 = d1.replace(year=current_year)
             if d2.year == 1900:
-                d2 = d2.replace(year=datetime.utcnow().year)
+                d2 = d2.replace(year=current_year)
             return d1, d2
         except Exception:
             pass
@@ -170,7 +190,7 @@ def extract_date_range(query: str) -> Tuple[date, date] | None:
     return None
 
 
-def summarize_answer(query: str, matches: List[dict]) -> str:
+def summarize_answer(query: str, matches: List[dict], store: VectorStore) -> str:
     """Summarize purchases with full support for item, merchant, and total expense queries across all date filters."""
     if not matches:
         return "I couldn’t find any matching items."
@@ -186,19 +206,17 @@ def summarize_answer(query: str, matches: List[dict]) -> str:
 
     # --- Detect item name from query ---
     item_name = None
-    item_match = re.search(r"where did i buy (.+?)(?: from| on|$)", q_lower)
+    item_match = _WHERE_BUY.search(q_lower)
     if item_match:
         item_name = item_match.group(1).strip().lower()
 
     # --- Helper: filter by date ---
-    def filter_matches(ms, date_check=None):
-        filtered = []
-        for m in ms:
-            date_val = parse_date(m["metadata"].get("date", ""))
-            if date_check and not date_check(date_val):
-                continue
-            filtered.append(m)
-        return filtered
+    def filter_matches(ms, start, end):
+        # The store keeps dates as pre-parsed ordinals (0 = unknown), so this is one vectorized
+        # comparison; matches the store doesn't know count as undated
+        ords = store.date_ordinals([m["id"] for m in ms])
+        mask = (ords >= start.toordinal()) & (ords <= end.toordinal())
+        return [ms[i] for i in np.flatnonzero(mask)]
 
     # --- Cosine similarity for merchant lookup ---
     def best_merchant_by_similarity(item_name, ms):
@@ -206,20 +224,16 @@ def summarize_answer(query: str, matches: List[dict]) -> str:
         if not candidates:
             return None, None
 
-        texts = [m["metadata"].get("text", "").lower() for m in candidates]
-        merchants = [m["metadata"].get("merchant") for m in candidates]
-
-        vectorizer = TfidfVectorizer().fit(texts + [item_name])
-        vectors = vectorizer.transform(texts + [item_name])
-        query_vec = vectors[-1].toarray()
-        item_vecs = vectors[:-1].toarray()
-
-        similarities = cosine_similarity(query_vec, item_vecs).flatten()
-        best_idx = similarities.argmax()
-        if similarities[best_idx] < 0.2:  # low confidence threshold
+        # Score against the store's own vectors: no refit, only the candidate rows. Candidates
+        # deleted since the query score -inf and so never pass the cutoff.
+        similarities = store.similarity_for_ids(item_name, [m["id"] for m in candidates])
+        best_idx = int(np.argmax(similarities))
+        score = similarities[best_idx]
+        if not np.isfinite(score) or score < MERCHANT_MIN_SIMILARITY:  # gone or low confidence
             return None, None
 
-        return texts[best_idx], merchants[best_idx]
+        best = candidates[best_idx]["metadata"]
+        return best.get("text", "").lower(), best.get("merchant")
 
     # --- Determine date filter ---
     start, end = None, None
@@ -237,7 +251,7 @@ def summarize_answer(query: str, matches: List[dict]) -> str:
 
     # --- Apply date filter ---
     if start and end:
-        filtered = filter_matches(matches, lambda d: isinstance(d, date) and start <= d <= end)
+        filtered = filter_matches(matches, start, end)
     else:
         filtered = matches
 
@@ -274,7 +288,7 @@ def summarize_answer(query: str, matches: List[dict]) -> str:
 def qa(q: str = Query(..., description="Natural language question")):
     try:
         matches = vdb.query(q, k=10)
-        summary = summarize_answer(q, matches)
+        summary = summarize_answer(q, matches, vdb)
         # return {
         #     "query": q,
         #     "answer": summary,
@@ -294,13 +308,14 @@ def vectors_upsert(req: UpsertReq):
         "price": float(req.price) if req.price is not None else None,
     }
     vdb.upsert(req.id, metadata)
+    vdb.flush()
     return {"ok": True, "count": vdb.count()}
 
 
 @app.post("/vectors/query")
 def vectors_query(req: QueryReq):
     matches = vdb.query(req.query, k=req.k)
-    summary = summarize_answer(req.query, matches)
+    summary = summarize_answer(req.query, matches, vdb)
     return {"answer": summary, "matches": matches}
 
 
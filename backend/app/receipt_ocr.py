@@ -2,6 +2,8 @@ import cv2
 import pytesseract
 import numpy as np
 import re
+import re2
+import hyperscan
 import datetime as dt
 from dateutil import parser as dparser
 from typing import Tuple, List, Dict, Any, Optional
@@ -10,14 +12,16 @@ from typing import Tuple, List, Dict, Any, Optional
 # CV preprocessing utilities
 # ---------------------------
 def _deskew(img_gray: np.ndarray) -> np.ndarray:
-    coords = np.column_stack(np.where(img_gray > 0))
-    if coords.shape[0] < 10:
+    # Text is dark on white after thresholding; findNonZero returns a compact Nx1x2 int32 array of (x, y)
+    coords = cv2.findNonZero(cv2.bitwise_not(img_gray))
+    if coords is None or coords.shape[0] < 10:
         return img_gray
     angle = cv2.minAreaRect(coords)[-1]
-    if angle < -45:
-        angle = -(90 + angle)
-    else:
-        angle = -angle
+    # Smallest equivalent rotation (OpenCV < 4.5 reports [-90, 0), newer versions (0, 90])
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
     (h, w) = img_gray.shape[:2]
     M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
     rotated = cv2.warpAffine(img_gray, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
@@ -25,15 +29,15 @@ def _deskew(img_gray: np.ndarray) -> np.ndarray:
 
 def _preprocess_image(img_bytes: bytes) -> np.ndarray:
     arr = np.frombuffer(img_bytes, np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    if img is None:
+    # Decode straight to grayscale and downscale before any filtering
+    gray = cv2.imdecode(arr, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
         raise ValueError("Could not decode image bytes")
-    h, w = img.shape[:2]
+    h, w = gray.shape[:2]
     if max(w, h) > 1600:
         scale = 1600 / max(w, h)
-        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.bilateralFilter(gray, 9, 75, 75)
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = cv2.medianBlur(gray, 3)
     gray = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
                                  cv2.THRESH_BINARY, 31, 2)
     gray = _deskew(gray)
@@ -42,7 +46,12 @@ def _preprocess_image(img_bytes: bytes) -> np.ndarray:
 # ---------------------------
 # Text parsing helpers
 # ---------------------------
-_money_rx = re.compile(r"([€$£]?)\s*([0-9]+(?:[.,][0-9]{1,2})?)")
+# Money amounts are extracted with RE2 (linear-time DFA, no backtracking)
+_money_rx = re2.compile(r"([€$£]?)\s*([0-9]+(?:[.,][0-9]{1,2})?)")
+
+_total_rx = re.compile(r"(total|amount due|amount|balance|grand total|amt due|payment)", re.IGNORECASE)
+_fallback_item_rx = re.compile(r"(.+?)\s+([0-9\.,]+\d)\s*$")
+_multi_space_rx = re.compile(r"\s{2,}")
 
 # Updated item line patterns to capture qty, name, unit_price, line_total
 _item_patterns = [
@@ -61,25 +70,64 @@ _date_patterns = [
     re.compile(r"(\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\s+\d{2,4})", re.IGNORECASE),
 ]
 
-def _is_likely_item_line(line: str) -> bool:
-    low = line.lower()
-    # skip headers, addresses, or receipt info
-    skip_keywords = (
-        "receipt", "invoice", "tax", "subtotal", "balance",
-        "billed to", "customer", "notes", "thank you", "food receipt"
+# ---------------------------
+# Single-pass line classifier
+# ---------------------------
+# Every per-line test is compiled into one Hyperscan database, so each OCR
+# line is scanned once and the Python regexes above only run on lines that
+# are known to match (to pull out capture groups).
+_HS_MONEY, _HS_TOTAL, _HS_ITEM = range(3)
+_HS_DATES = tuple(range(3, 3 + len(_date_patterns)))
+
+def _build_line_db() -> hyperscan.Database:
+    exprs = [
+        (_HS_MONEY, r"[0-9]", 0),
+        (_HS_TOTAL, _total_rx.pattern, hyperscan.HS_FLAG_CASELESS),
+        (_HS_ITEM, _item_patterns[0].pattern, 0),
+    ] + [
+        (hs_id, pat.pattern, hyperscan.HS_FLAG_CASELESS if pat.flags & re.IGNORECASE else 0)
+        for hs_id, pat in zip(_HS_DATES, _date_patterns)
+    ]
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[e.encode("utf-8") for _, e, _ in exprs],
+        ids=[i for i, _, _ in exprs],
+        elements=len(exprs),
+        # Only "does it match" is needed, so report each id at most once per scan. UTF8|UCP give
+        # \s, \d and \w the Unicode meaning Python's re uses (e.g. \s matches NBSP), so Hyperscan
+        # never rejects a line the Python pattern would match.
+        flags=[f | hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP
+               for _, _, f in exprs],
     )
-    if any(k in low for k in skip_keywords):
-        return False
-    # must contain at least one numeric price at end
-    return bool(re.search(r"\d+\.\d{2}\s*$", line))
+    return db
+
+_line_db = _build_line_db()  # scratch space is allocated once with the database
+
+def _on_line_match(id, start, end, flags, context):
+    context.add(id)
+
+def _classify_line(line: str) -> set:
+    """Ids of the _HS_* patterns that match line, from a single scan."""
+    found = set()
+    _line_db.scan(line.encode("utf-8"), match_event_handler=_on_line_match, context=found)
+    return found
+
+# skip headers, addresses, or receipt info
+_skip_item_keywords = (
+    "receipt", "invoice", "tax", "subtotal", "balance",
+    "billed to", "customer", "notes", "thank you", "food receipt"
+)
 
 def _safe_float(s: str) -> Optional[float]:
     if s is None:
         return None
-    s = s.strip().replace(",", ".")
-    if s.count(".") > 1:
-        parts = s.split(".")
-        s = "".join(parts[:-1]) + "." + parts[-1]
+    s = s.strip()
+    if "," in s:
+        s = s.replace(",", ".")
+    # Every separator but the last is a thousands separator
+    head, _, tail = s.rpartition(".")
+    if "." in head:
+        s = head.replace(".", "") + "." + tail
     try:
         return float(s)
     except Exception:
@@ -100,10 +148,14 @@ def extract_receipt(img_bytes: bytes) -> Tuple[Dict[str, Any], List[Dict[str, An
     merchant = next((ln for ln in lines[:5] if len(ln) > 2 and ln.lower() not in ("receipt","invoice","tax","total","subtotal","balance")), None)
     merchant = merchant or (lines[0] if lines else "Unknown")
 
+    line_classes = [_classify_line(ln) for ln in lines]
+
     # Date
     parsed_date = None
-    for ln in lines:
-        for pat in _date_patterns:
+    for ln, classes in zip(lines, line_classes):
+        for hs_id, pat in zip(_HS_DATES, _date_patterns):
+            if hs_id not in classes:
+                continue
             m = pat.search(ln)
             if m:
                 try:
@@ -126,8 +178,8 @@ def extract_receipt(img_bytes: bytes) -> Tuple[Dict[str, Any], List[Dict[str, An
     # Total
     total_value = None
     currency = None
-    for ln in reversed(lines[-12:]):
-        if re.search(r"(total|amount due|amount|balance|grand total|amt due|payment)", ln, re.IGNORECASE):
+    for ln, classes in zip(reversed(lines[-12:]), reversed(line_classes[-12:])):
+        if _HS_TOTAL in classes and _HS_MONEY in classes:
             m = _money_rx.search(ln)
             if m:
                 currency = m.group(1) or ""
@@ -136,7 +188,9 @@ def extract_receipt(img_bytes: bytes) -> Tuple[Dict[str, Any], List[Dict[str, An
                     break
     if total_value is None:
         candidate = None
-        for ln in lines[-20:]:
+        for ln, classes in zip(lines[-20:], line_classes[-20:]):
+            if _HS_MONEY not in classes:
+                continue
             for m in _money_rx.finditer(ln):
                 val = _safe_float(m.group(2))
                 if val is not None and (candidate is None or val > candidate[0]):
@@ -146,12 +200,18 @@ def extract_receipt(img_bytes: bytes) -> Tuple[Dict[str, Any], List[Dict[str, An
 
     # Items
     items = []
-    for ln in lines:
-        if not _is_likely_item_line(ln):
+    for ln, classes in zip(lines, line_classes):
+        # Cheap checks before any regex: sane length and a trailing d.dd price (lines are stripped)
+        if len(ln) < 6 or len(ln) > 120:
+            continue
+        if not (ln[-1].isdigit() and ln[-2].isdigit() and ln[-3] == "." and ln[-4].isdigit()):
+            continue
+        low = ln.lower()
+        if any(k in low for k in _skip_item_keywords):
             continue  # skip headers/addresses
 
         matched = False
-        for pat in _item_patterns:
+        for pat in (_item_patterns if _HS_ITEM in classes else ()):
             m = pat.match(ln)
             if not m:
                 continue
@@ -160,7 +220,7 @@ def extract_receipt(img_bytes: bytes) -> Tuple[Dict[str, Any], List[Dict[str, An
             unit_price = _safe_float(m.group("unit_price"))
             line_total = _safe_float(m.group("line_total")) or (unit_price * qty if unit_price else None)
             items.append({
-                "name": re.sub(r"\s{2,}", " ", name),
+                "name": _multi_space_rx.sub(" ", name),
                 "qty": qty,
                 "unit_price": unit_price,
                 "line_total": line_total,
@@ -171,12 +231,12 @@ def extract_receipt(img_bytes: bytes) -> Tuple[Dict[str, Any], List[Dict[str, An
             break
         if not matched:
             # fallback heuristic
-            m = re.search(r"(.+?)\s+([0-9\.,]+\d)\s*$", ln)
+            m = _fallback_item_rx.search(ln)
             if m:
                 name = m.group(1).strip()
                 val = _safe_float(m.group(2)) or 0.0
                 items.append({
-                    "name": re.sub(r"\s{2,}", " ", name),
+                    "name": _multi_space_rx.sub(" ", name),
                     "qty": 1.0,
                     "unit_price": None,
                     "line_total": val,
@@ -1,104 +1,436 @@
+import functools
 import json
 import os
+import threading
 import numpy as np
-from typing import List, Dict, Any
-from sklearn.feature_extraction.text import TfidfVectorizer
+import simsimd
+from datetime import date, datetime
+from sentence_transformers import SentenceTransformer
+from typing import List, Dict, Any, Optional, Tuple
+
+_EMBED_MODEL = "all-MiniLM-L6-v2"
+_LOG_BUFFER = 1 << 20
+_COMPACT_MIN_BYTES = 1 << 20  # never compact logs smaller than this
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# Vector file layout: a random snapshot token (also recorded on the log's first
+# line, with the row format) followed by one row per slot: the int8-quantized
+# embedding and its float32 scale. Log records point at their row with "vec": slot.
+_VEC_HEADER = 16
+_VEC_FORMAT = "i8-scaled"
+
+
+def _date_ordinal(value: Optional[str]) -> int:
+    """YYYY-MM-DD -> proleptic Gregorian ordinal; 0 when missing or unparseable."""
+    if not value or not isinstance(value, str):
+        return 0
+    # Canonical YYYY-MM-DD only (3.11+ fromisoformat also takes "20250104", "2025-W01-1")
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        try:
+            return date.fromisoformat(value).toordinal()
+        except ValueError:
+            pass
+    try:
+        # strptime also accepts unpadded fields such as 2025-1-4
+        return datetime.strptime(value, "%Y-%m-%d").toordinal()
+    except Exception:
+        return 0
+
+
+def _price_value(value) -> float:
+    try:
+        return float(value) if value is not None else np.nan
+    except Exception:
+        return np.nan
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < scores.size:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(scores.size)
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def _locked(method):
+    """Run a VectorStore method while holding the store's lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class VectorStore:
     def __init__(self, path: str):
-        self.path = path
-        self.vectors: Dict[str, Dict[str, Any]] = {}
-        self.texts: List[str] = []   # raw texts
-        self.ids: List[str] = []     # keep IDs aligned with texts
-        self.vectorizer = None
-        self.matrix = None
-        if os.path.exists(path):
-            self._load()
-            self._rebuild()
-
-    def _load(self):
-        """Load vectors (metadata + text) from JSONL."""
-        self.vectors = {}
-        self.texts = []
-        self.ids = []
-        with open(self.path, "r", encoding="utf-8") as f:
-            for line in f:
-                obj = json.loads(line)
-                self.vectors[obj["id"]] = obj
-                self.ids.append(obj["id"])
-                self.texts.append(obj["metadata"].get("text", ""))
-
-    def _save(self):
-        """Save all vectors to JSONL."""
-        with open(self.path, "w", encoding="utf-8") as f:
-            for obj in self.vectors.values():
-                f.write(json.dumps(obj) + "\n")
-
-    def _rebuild(self):
-        """Rebuild TF-IDF matrix after inserts/deletes."""
-        if not self.texts:
-            self.vectorizer = None
-            self.matrix = None
+        # Endpoints run in a threadpool and encoding releases the GIL: writers must not interleave
+        # between appending a vector and logging its slot, or close files under each other (RLock
+        # because flush/reset call compact)
+        self._lock = threading.RLock()
+        self.path = path                                    # JSONL op log (metadata)
+        self.vec_path = os.path.splitext(path)[0] + ".bin"  # binary row vectors
+        # Sentence embeddings are computed once per upsert; queries only pay for a dot product
+        self.encoder = SentenceTransformer(_EMBED_MODEL)
+        self.dim = self.encoder.get_sentence_embedding_dimension()
+        self._row_dtype = np.dtype([("q", "i1", (self.dim,)), ("scale", "<f4")])
+        self._clear()
+        self._file = None
+        self._vec_file = None
+        self._vec_len = 0         # row slots in the vector file
+        self._snapshot_bytes = 0  # size of the log right after the last load/compaction
+        self._dirty_bytes = 0     # bytes appended since then
+        # The store opens its files up front, so make sure e.g. an unmounted /data exists
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path) and self._load():
+            self._open_files()
+        else:
+            # New store, or a log whose vector file is missing/out of step: write both afresh
+            self.compact()
+
+    def _clear(self):
+        # Column-per-field (SoA) layout; row i of every column is the same record
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.merchants: List[Optional[str]] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self.id_to_idx: Dict[str, int] = {}
+        self._dates = np.zeros(16, dtype=np.int32)     # date ordinals, 0 = unknown
+        self._prices = np.zeros(16, dtype=np.float32)  # NaN = unknown
+        # Unit-norm embeddings stored as int8 * per-row scale (4x less data to scan than f32)
+        self._vectors = np.zeros((16, self.dim), dtype=np.int8)
+        self._scales = np.zeros(16, dtype=np.float32)
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self._dates[: len(self.ids)]
+
+    @property
+    def prices(self) -> np.ndarray:
+        return self._prices[: len(self.ids)]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """(N, dim) int8 quantized embedding matrix of all rows."""
+        return self._vectors[: len(self.ids)]
+
+    @property
+    def scales(self) -> np.ndarray:
+        """Per-row dequantization scales: embedding ~= matrix[i] * scales[i]."""
+        return self._scales[: len(self.ids)]
+
+    def _reserve(self, n: int):
+        """Grow the numeric columns geometrically so appends are amortized O(1)."""
+        if n <= self._dates.shape[0]:
             return
-        self.vectorizer = TfidfVectorizer(stop_words="english")
-        self.matrix = self.vectorizer.fit_transform(self.texts).toarray()  # store as ndarray
+        cap = max(n, 2 * self._dates.shape[0])
+        self._dates = np.resize(self._dates, cap)
+        self._prices = np.resize(self._prices, cap)
+        self._vectors = np.resize(self._vectors, (cap, self.dim))
+        self._scales = np.resize(self._scales, cap)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Embed and quantize texts into vector-file rows (structured "q"/"scale" records)."""
+        v = self.encoder.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+        scale = np.abs(v).max(axis=1) / 127
+        scale[scale == 0] = 1.0
+        rows = np.empty(len(texts), dtype=self._row_dtype)
+        rows["q"] = np.rint(v / scale[:, None]).astype(np.int8)
+        rows["scale"] = scale
+        return rows
+
+    def _set_row(self, id: str, metadata: Dict[str, Any], vec) -> bool:
+        """Write one record into the columns; returns True when it was an update."""
+        idx = self.id_to_idx.get(id)
+        text = metadata.get("text", "")
+        if idx is None:
+            idx = len(self.ids)
+            self._reserve(idx + 1)
+            self.id_to_idx[id] = idx
+            self.ids.append(id)
+            self.texts.append(text)
+            self.merchants.append(metadata.get("merchant"))
+            self.metadatas.append(metadata)
+            updated = False
+        else:
+            self.texts[idx] = text
+            self.merchants[idx] = metadata.get("merchant")
+            self.metadatas[idx] = metadata
+            updated = True
+        self._dates[idx] = _date_ordinal(metadata.get("date"))
+        self._prices[idx] = _price_value(metadata.get("price"))
+        if vec is not None:
+            self._vectors[idx] = vec["q"]
+            self._scales[idx] = vec["scale"]
+        return updated
+
+    def _remove_row(self, idx: int):
+        """Drop row idx by moving the last row into its slot."""
+        last = len(self.ids) - 1
+        del self.id_to_idx[self.ids[idx]]
+        if idx != last:
+            for col in (self.ids, self.texts, self.merchants, self.metadatas):
+                col[idx] = col[last]
+            self._dates[idx] = self._dates[last]
+            self._prices[idx] = self._prices[last]
+            self._vectors[idx] = self._vectors[last]
+            self._scales[idx] = self._scales[last]
+            self.id_to_idx[self.ids[idx]] = idx
+        for col in (self.ids, self.texts, self.merchants, self.metadatas):
+            col.pop()
+
+    def _open_files(self):
+        self._file = open(self.path, "a", encoding="utf-8", buffering=_LOG_BUFFER)
+        self._vec_file = open(self.vec_path, "ab", buffering=_LOG_BUFFER)
 
+    def _close_files(self):
+        for f in (self._file, self._vec_file):
+            if f is not None:
+                f.close()
+        self._file = None
+        self._vec_file = None
+
+    def _read_vectors(self):
+        """Snapshot token and memory-mapped rows of the vector file, or (None, None) if unusable."""
+        if not os.path.exists(self.vec_path):
+            return None, None
+        size = os.path.getsize(self.vec_path) - _VEC_HEADER
+        row_bytes = self._row_dtype.itemsize
+        if size < 0:
+            return None, None
+        n = size // row_bytes
+        if size % row_bytes:
+            # Torn append: drop the partial row so new rows stay aligned (its record re-encodes)
+            os.truncate(self.vec_path, _VEC_HEADER + n * row_bytes)
+        with open(self.vec_path, "rb") as f:
+            token = f.read(_VEC_HEADER).hex()
+        if n == 0:
+            return token, np.empty(0, dtype=self._row_dtype)
+        return token, np.memmap(self.vec_path, dtype=self._row_dtype, mode="r", offset=_VEC_HEADER, shape=(n,))
+
+    def _fill_vectors(self, rows, refs) -> int:
+        """Copy stored embeddings into the matrix; rows without a usable ref are re-encoded.
+
+        Returns the number of re-encoded rows.
+        """
+        n = len(self.texts)
+        usable = np.array(
+            [rows is not None and isinstance(ref, int) and 0 <= ref < len(rows) for ref in refs],
+            dtype=bool,
+        )
+        if usable.any():
+            slots = np.array([ref if ok else 0 for ref, ok in zip(refs, usable)], dtype=np.intp)
+            stored = rows[slots[usable]]
+            self._vectors[:n][usable] = stored["q"]
+            self._scales[:n][usable] = stored["scale"]
+        missing = np.flatnonzero(~usable)
+        if missing.size:
+            encoded = self._encode([self.texts[i] for i in missing])
+            self._vectors[missing] = encoded["q"]
+            self._scales[missing] = encoded["scale"]
+        return int(missing.size)
+
+    def _load(self) -> bool:
+        """Replay the append-only JSONL log: later upserts for an id win, deletes are tombstones.
+
+        Returns False when embeddings had to be recomputed from text because the
+        vector file is missing or belongs to a different snapshot.
+        """
+        live: Dict[str, Any] = {}
+        live_bytes: Dict[str, int] = {}
+        total_bytes = 0
+        header_bytes = 0
+        token = None
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated line")
+                    obj = json.loads(line)
+                except ValueError:
+                    if f.read(1):
+                        raise
+                    # A crash mid-append leaves a torn last line; it was never flushed, so drop it
+                    os.truncate(self.path, total_bytes)
+                    break
+                total_bytes += len(line)
+                # Lines without "op" predate the log format and are plain upserts
+                op = obj.get("op", "upsert")
+                if op == "snapshot":
+                    # Rows written in another layout cannot be read; treat as a token mismatch
+                    token = obj["token"] if obj.get("format") == _VEC_FORMAT else None
+                    header_bytes = len(line)
+                elif op == "delete":
+                    live.pop(obj["id"], None)
+                    live_bytes.pop(obj["id"], None)
+                else:
+                    live[obj["id"]] = (obj["metadata"], obj.get("vec"))
+                    live_bytes[obj["id"]] = len(line)
+        for id, (metadata, _) in live.items():
+            self._set_row(id, metadata, None)
+
+        vec_token, rows = self._read_vectors()
+        in_step = token is not None and token == vec_token
+        reencoded = self._fill_vectors(rows if in_step else None, [vec for _, vec in live.values()])
+        self._vec_len = len(rows) if in_step else 0
+        self._snapshot_bytes = header_bytes + sum(live_bytes.values())
+        self._dirty_bytes = total_bytes - self._snapshot_bytes
+        return in_step and reencoded == 0
+
+    def _append(self, obj: Dict[str, Any]):
+        """Append one operation to the log instead of rewriting it."""
+        line = json.dumps(obj) + "\n"
+        self._file.write(line)
+        self._dirty_bytes += len(line)
+
+    def _append_vector(self, vec) -> int:
+        """Append one quantized embedding row to the vector file; returns its slot."""
+        self._vec_file.write(vec.tobytes())
+        slot = self._vec_len
+        self._vec_len += 1
+        return slot
+
+    @_locked
+    def compact(self):
+        """Rewrite log and vector file as a snapshot of live records and atomically swap them in."""
+        token = os.urandom(_VEC_HEADER)
+
+        vec_tmp_path = self.vec_path + ".tmp"
+        rows = np.empty(len(self.ids), dtype=self._row_dtype)
+        rows["q"] = self.matrix
+        rows["scale"] = self.scales
+        with open(vec_tmp_path, "wb") as f:
+            f.write(token)
+            f.write(rows.tobytes())
+            f.flush()
+            _fdatasync(f.fileno())
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", buffering=_LOG_BUFFER) as f:
+            line = json.dumps({"op": "snapshot", "token": token.hex(), "format": _VEC_FORMAT}) + "\n"
+            f.write(line)
+            written = len(line)
+            for i, (id, metadata) in enumerate(zip(self.ids, self.metadatas)):
+                line = json.dumps({"op": "upsert", "id": id, "metadata": metadata, "vec": i}) + "\n"
+                f.write(line)
+                written += len(line)
+            f.flush()
+            _fdatasync(f.fileno())
+
+        self._close_files()
+        # Vector file first: if we stop in between, the tokens disagree and the next load re-encodes
+        os.replace(vec_tmp_path, self.vec_path)
+        os.replace(tmp_path, self.path)
+        self._open_files()
+        self._vec_len = len(self.ids)
+        self._snapshot_bytes = written
+        self._dirty_bytes = 0
+
+    @_locked
+    def flush(self):
+        """Durably commit appended operations; call once per request, not per upsert."""
+        # Vectors before the log records that point at them
+        for f in (self._vec_file, self._file):
+            f.flush()
+            _fdatasync(f.fileno())
+        if self._dirty_bytes > max(2 * self._snapshot_bytes, _COMPACT_MIN_BYTES):
+            self.compact()
+
+    @_locked
     def reset(self):
-        self.vectors = {}
-        self.texts = []
-        self.ids = []
-        self.vectorizer = None
-        self.matrix = None
-        if os.path.exists(self.path):
-            os.remove(self.path)
+        self._clear()
+        self._close_files()
+        for p in (self.path, self.vec_path):
+            if os.path.exists(p):
+                os.remove(p)
+        self.compact()
 
     def count(self) -> int:
-        return len(self.vectors)
+        return len(self.ids)
     
     def upsert(self, id: str, metadata: Dict[str, Any]):
         """Insert or update a vector with metadata."""
-        # Normalize date
-        date_val = metadata.get("date")
-        if date_val is not None and not isinstance(date_val, str):
-            try:
-                metadata["date"] = str(date_val)
-            except Exception:
-                metadata["date"] = None
+        self.upsert_many([(id, metadata)])
+
+    def upsert_many(self, records: List[Tuple[str, Dict[str, Any]]]):
+        """Insert or update several (id, metadata) records with a single encoder pass."""
+        if not records:
+            return
+        for _, metadata in records:
+            # Normalize date
+            date_val = metadata.get("date")
+            if date_val is not None and not isinstance(date_val, str):
+                try:
+                    metadata["date"] = str(date_val)
+                except Exception:
+                    metadata["date"] = None
+
+        # Encode outside the lock; only the in-memory and on-disk writes are serialized
+        vecs = self._encode([metadata.get("text", "") for _, metadata in records])
+        with self._lock:
+            for (id, metadata), vec in zip(records, vecs):
+                self._set_row(id, metadata, vec)
+                self._append({"op": "upsert", "id": id, "metadata": metadata, "vec": self._append_vector(vec)})
+
+    @_locked
+    def delete(self, id: str) -> bool:
+        """Remove a vector; returns False when the id is unknown."""
+        idx = self.id_to_idx.get(id)
+        if idx is None:
+            return False
+        self._remove_row(idx)
+        self._append({"op": "delete", "id": id})
+        return True
 
-        self.vectors[id] = {"id": id, "metadata": metadata}
-        self.ids = list(self.vectors.keys())
-        self.texts = [self.vectors[i]["metadata"].get("text", "") for i in self.ids]
+    def _scores(self, q, rows=None) -> np.ndarray:
+        """Cosine similarity of an encoded query row against the stored rows; caller holds the lock."""
+        m = self.matrix if rows is None else self.matrix[rows]
+        if m.shape[0] == 0:
+            return np.empty(0, dtype=np.float32)
+        scales = self.scales if rows is None else self.scales[rows]
+        # int8 dot products (VNNI on CPUs that have it); rescaled, they approximate the cosine
+        # of the unit-norm embeddings
+        dots = np.asarray(simsimd.cdist(np.ascontiguousarray(q["q"]), m, metric="dot"), dtype=np.float32).ravel()
+        return dots * (q["scale"][0] * scales)
 
-        self._rebuild()
-        self._save()
+    def similarity_for_ids(self, text: str, ids: List[str]) -> np.ndarray:
+        """Cosine similarity of text against the given ids' rows; -inf for ids no longer stored."""
+        q = self._encode([text])
+        out = np.full(len(ids), -np.inf, dtype=np.float32)
+        # Resolve ids to rows under the lock: a delete moves the last row into the freed slot
+        with self._lock:
+            found = [(j, self.id_to_idx[id]) for j, id in enumerate(ids) if id in self.id_to_idx]
+            if found:
+                pos, rows = zip(*found)
+                out[list(pos)] = self._scores(q, list(rows))
+        return out
+
+    @_locked
+    def date_ordinals(self, ids: List[str]) -> np.ndarray:
+        """Date ordinals of the given ids; 0 when unknown or the id is no longer stored."""
+        idxs = (self.id_to_idx.get(id) for id in ids)
+        return np.fromiter((self._dates[i] if i is not None else 0 for i in idxs), dtype=np.int32, count=len(ids))
 
     def query(self, query_text: str, k: int = 5):
-        """Return top-k matches by cosine similarity on TF-IDF (manual implementation)."""
-        if self.vectorizer is None or self.matrix is None or not self.texts:
+        """Return top-k matches by cosine similarity of sentence embeddings."""
+        if not self.ids:
             return []
 
-        # Query vector
-        q_vec = self.vectorizer.transform([query_text]).toarray()[0]
-
-        # Manual cosine similarity
-        norm_q = np.linalg.norm(q_vec)
-        sims = []
-        for doc_vec in self.matrix:
-            norm_d = np.linalg.norm(doc_vec)
-            if norm_q == 0 or norm_d == 0:
-                sim = 0.0
-            else:
-                sim = float(np.dot(q_vec, doc_vec) / (norm_q * norm_d))
-            sims.append(sim)
-
-        scored = []
-        for idx, id in enumerate(self.ids):
-            scored.append({
-                "id": id,
-                "score": sims[idx],
-                "metadata": self.vectors[id]["metadata"],
-            })
-
-        scored.sort(key=lambda x: x["score"], reverse=True)
-        return scored[:k]
+        q = self._encode([query_text])
+        # Score and read the rows under one lock so a concurrent delete can't shift indices
+        with self._lock:
+            sims = self._scores(q)
+
+            # Only the k winners are turned into Python objects
+            return [
+                {
+                    "id": self.ids[i],
+                    "score": float(sims[i]),
+                    "metadata": self.metadatas[i],
+                }
+                for i in _top_k(sims, k)
+            ]